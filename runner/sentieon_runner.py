@@ -17,41 +17,244 @@ import ssl
 import warnings
 import logging
 import random
+import collections
 import google.auth
 import googleapiclient.errors
 
 from apiclient.discovery import build
-from pprint import pformat
+from concurrent.futures import ThreadPoolExecutor
 from googleapiclient.errors import HttpError
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as YamlLoader
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 script_dir = os.path.dirname(os.path.realpath(__file__))
 germline_yaml = script_dir + "/germline.yaml"
 somatic_yaml = script_dir + "/somatic.yaml"
 ccdg_yaml = script_dir + "/ccdg.yaml"
 default_json = script_dir + "/runner_default.json"
+germline_pipelines = frozenset(("GERMLINE", "CCDG"))
+somatic_pipelines = frozenset(("SOMATIC",))
+pipelines = {
+    "GERMLINE": (germline_yaml, "/opt/sentieon/gc_germline.sh"),
+    "SOMATIC": (somatic_yaml, "/opt/sentieon/gc_somatic.sh"),
+    "CCDG": (ccdg_yaml, "/opt/sentieon/gc_ccdg_germline.sh"),
+}
 target_url_base = ("https://www.googleapis.com/compute/v1/projects/{project}/"
                    "zones/{zone}/instances/{instance}")
+preempted_filter = ("(targetLink eq {url}) (operationType eq "
+                    "compute.instances.preempted)")
+initial_polling_interval = 2
+worker_assigned_key = "workerAssigned"
+
+
+class JsonDump(object):
+    '''
+    Format an object as indented JSON only when it is logged
+    '''
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, indent=2, default=str)
+
+
+_storage_client = None
+_compute_service = None
+_config_cache = {}
+_exists_cache = {}
+
+
+def load_yaml(f):
+    return yaml.load(f, Loader=YamlLoader)
+
+
+def load_json(f):
+    if orjson is not None:
+        return orjson.loads(f.read())
+    return json.load(f)
+
+
+def load_config(path, loader=load_json):
+    '''
+    Parse a configuration file, caching the result on its path and mtime
+
+    A copy is returned so callers are free to modify it.
+    '''
+    key = (path, os.path.getmtime(path), loader)
+    if key not in _config_cache:
+        with open(path, 'rb') as f:
+            _config_cache[key] = loader(f)
+    return copy.deepcopy(_config_cache[key])
+
+
+def get_storage_client(credentials):
+    '''
+    Return the shared storage client, creating it on first use
+
+    The client's session is mounted with a larger connection pool so that
+    concurrent existence checks reuse warm connections.
+    '''
+    global _storage_client
+    if _storage_client is None:
+        from google.cloud import storage
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", "Your application has "
+                                    "authenticated using end user "
+                                    "credentials from Google Cloud SDK")
+            client = storage.Client(credentials=credentials)
+        adapter = HTTPAdapter(
+                pool_connections=64,
+                pool_maxsize=64,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.5,
+                    status_forcelist=(500, 502, 503, 504)))
+        client._http.mount("https://", adapter)
+        _storage_client = client
+    return _storage_client
+
+
+def get_compute_service(credentials):
+    '''
+    Return the shared compute API client, creating it on first use
+    '''
+    global _compute_service
+    if _compute_service is None:
+        _compute_service = build("compute", "v1", credentials=credentials)
+    return _compute_service
 
 
 def cloud_storage_exists(client, gs_path):
+    if gs_path in _exists_cache:
+        return _exists_cache[gs_path]
     try:
         bucket, blob = gs_path[5:].split('/', 1)
         bucket = client.bucket(bucket)
         blob = bucket.blob(blob)
-        res = blob.exists()
+        # A one byte ranged GET avoids fetching the object metadata. The
+        # body is streamed in case the range is ignored; small responses are
+        # read so the connection returns to the pool, while a full 200 body
+        # is dropped by closing the connection.
+        res = client._http.request(
+                "GET", blob.public_url, headers={"Range": "bytes=0-0"},
+                stream=True)
+        if res.status_code == 200:
+            res.close()
+        else:
+            res.content
     except:  # Catch all exceptions
         raise ValueError("Error: Could not find {gs_path} in Google Cloud "
                          "Storage".format(**locals()))
-    return res
+    # 404 is a missing object and 416 is returned for an existing, empty one
+    if res.status_code not in (200, 206, 404, 416):
+        raise ValueError("Error: Could not find {gs_path} in Google Cloud "
+                         "Storage".format(**locals()))
+    _exists_cache[gs_path] = res.status_code != 404
+    return _exists_cache[gs_path]
+
+
+def list_cloud_storage_paths(client, gs_paths, max_results=1000):
+    '''
+    Check the existence of many files with one listing per directory
+
+    Paths are grouped by bucket and directory, and each group is listed once
+    under the longest prefix shared by its files. Returns a dict of paths to
+    their existence. Groups that cannot be listed or that hold more than
+    `max_results` matching objects are left out of the result.
+    '''
+    groups = collections.defaultdict(set)
+    for gs_path in gs_paths:
+        try:
+            bucket, blob = gs_path[5:].split('/', 1)
+        except ValueError:
+            continue
+        groups[(bucket, os.path.dirname(blob))].add(blob)
+
+    found = {}
+    for (bucket, _), blobs in groups.items():
+        prefix = os.path.commonprefix(list(blobs))
+        try:
+            listing = client.bucket(bucket).list_blobs(
+                    prefix=prefix,
+                    max_results=max_results + 1,
+                    fields="items(name),nextPageToken")
+            names = set(listed.name for listed in listing)
+        except Exception as e:  # Fall back to checking each file
+            logging.debug("Could not list gs://{}/{}: {}".format(
+                bucket, prefix, e))
+            continue
+        if len(names) > max_results:
+            continue
+        for blob in blobs:
+            found["gs://{}/{}".format(bucket, blob)] = blob in names
+    return found
+
+
+def batch_cloud_storage_exists(service, gs_paths, batch_size=100):
+    '''
+    Check the existence of files with batched JSON API requests
+
+    Up to `batch_size` object lookups are sent in each HTTP request. Returns
+    a dict of paths to their existence. Paths whose lookup failed with
+    anything other than a 404 are left out of the result.
+    '''
+    objects = []
+    for gs_path in set(gs_paths):
+        try:
+            bucket, blob = gs_path[5:].split('/', 1)
+        except ValueError:
+            continue
+        objects.append((gs_path, bucket, blob))
+
+    found = {}
+
+    def callback(request_id, response, exception):
+        gs_path = objects[int(request_id)][0]
+        if exception is None:
+            found[gs_path] = True
+        elif isinstance(exception, HttpError) and exception.resp.status == 404:
+            found[gs_path] = False
+        else:
+            logging.debug("Could not check {}: {}".format(gs_path, exception))
+
+    for start in range(0, len(objects), batch_size):
+        batch = service.new_batch_http_request(callback=callback)
+        for i in range(start, min(start + batch_size, len(objects))):
+            _, bucket, blob = objects[i]
+            batch.add(service.objects().get(
+                bucket=bucket, object=blob, fields="name"), request_id=str(i))
+        try:
+            batch.execute()
+        except Exception as e:  # Fall back to checking each file
+            logging.debug("Batched lookup failed: {}".format(e))
+    return found
+
+
+def probe_cloud_storage_paths(client, gs_paths, max_workers=32):
+    '''
+    Check the existence of files concurrently, one request per file
+    '''
+    gs_paths = list(set(gs_paths))
+    if not gs_paths:
+        return {}
+    with ThreadPoolExecutor(
+            max_workers=min(max_workers, len(gs_paths))) as executor:
+        return dict(zip(gs_paths, executor.map(
+            lambda gs_path: cloud_storage_exists(client, gs_path),
+            gs_paths)))
 
 
 def check_inputs_exist(job_vars, credentials):
-    from google.cloud import storage
-    with warnings.catch_warnings():
-        warnings.filterwarnings("ignore", "Your application has authenticated "
-                                "using end user credentials from Google Cloud "
-                                "SDK")
-        client = storage.Client(credentials=credentials)
+    client = get_storage_client(credentials)
 
     # The DBSNP, BQSR and Realign sites files
     sites_files = []
@@ -60,21 +263,9 @@ def check_inputs_exist(job_vars, credentials):
     sites_files += (job_vars["REALIGN_SITES"].split(',') if
                     job_vars["REALIGN_SITES"] else [])
     sites_files += [job_vars["DBSNP"]] if job_vars["DBSNP"] else []
-    for sites_file in sites_files:
-        if not cloud_storage_exists(client, sites_file):
-            logging.error("Could not find supplied file "
-                          "{}".format(sites_file))
-            sys.exit(-1)
-        if sites_file.endswith("vcf.gz"):
-            if not cloud_storage_exists(client, sites_file + ".tbi"):
-                logging.error("Could not find index for file "
-                              "{}".format(sites_file))
-                sys.exit(-1)
-        else:
-            if not cloud_storage_exists(client, sites_file + ".idx"):
-                logging.error("Could not find index for file "
-                              "{}".format(sites_file))
-                sys.exit(-1)
+    sites_indices = [
+        sites_file + (".tbi" if sites_file.endswith("vcf.gz") else ".idx")
+        for sites_file in sites_files]
 
     # The data input files
     gs_split_files = (
@@ -84,51 +275,187 @@ def check_inputs_exist(job_vars, credentials):
             job_vars["TUMOR_FQ2"],
             job_vars["BAM"],
             job_vars["TUMOR_BAM"])
-    gs_files = ()
-    for split_file in gs_split_files:
-        if not split_file:
-            continue
-        for input_file in split_file.split(','):
-            if not cloud_storage_exists(client, input_file):
-                logging.error("Could not find the supplied file "
-                              "{}".format(input_file))
-                sys.exit(-1)
-    for input_file in gs_files:
-        if not cloud_storage_exists(client, input_file):
-            logging.error("Could not file the supplied file "
-                          "{}".format(input_file))
-            sys.exit(-1)
+    input_files = [input_file for split_file in gs_split_files if split_file
+                   for input_file in split_file.split(',')]
 
     # All reference files
     ref = job_vars["REF"]
     ref_base = ref[:-3] if ref.endswith(".fa") else ref[:-6]
-    if not cloud_storage_exists(client, ref):
+    ref_files = [ref, ref + ".fai", ref + ".dict", ref_base + ".dict"]
+    bwa_suffixes = [".amb", ".ann", ".bwt", ".pac", ".sa"]
+    if job_vars["FQ1"] or job_vars["TUMOR_FQ1"]:
+        for suffix in bwa_suffixes:
+            ref_files += [ref + suffix, ref + ".64" + suffix]
+
+    # The BAM index files
+    bam_vars = ("BAM", "TUMOR_BAM")
+    bam_indices = []
+    for bam_type in bam_vars:
+        if job_vars[bam_type]:
+            for bam in job_vars[bam_type].split(','):
+                bam_indices += [bam + ".bai", bam + "bai"]
+
+    # Resolve as many files as possible with a few directory listings, look
+    # up the remainder in batched requests and probe anything left
+    # concurrently. The reference and its indices are listed on their own so
+    # the listing is limited to the reference stem. Results are shared
+    # through the cloud_storage_exists cache.
+    paths = (sites_files + sites_indices + input_files + ref_files +
+             bam_indices)
+    _exists_cache.update(list_cloud_storage_paths(client, ref_files))
+    _exists_cache.update(list_cloud_storage_paths(
+        client, [path for path in paths if path not in _exists_cache]))
+    unresolved = [path for path in paths if path not in _exists_cache]
+    if unresolved:
+        try:
+            storage_service = build("storage", "v1", credentials=credentials)
+        except Exception as e:  # Fall back to checking each file
+            logging.debug("Could not build the storage service: {}".format(e))
+        else:
+            _exists_cache.update(batch_cloud_storage_exists(
+                storage_service, unresolved))
+    probe_cloud_storage_paths(
+        client, [path for path in paths if path not in _exists_cache])
+
+    def exists(gs_path):
+        return cloud_storage_exists(client, gs_path)
+
+    # Report every missing file before exiting
+    missing = []
+    for sites_file, sites_index in zip(sites_files, sites_indices):
+        if not exists(sites_file):
+            logging.error("Could not find supplied file "
+                          "{}".format(sites_file))
+            missing.append(sites_file)
+        if not exists(sites_index):
+            logging.error("Could not find index for file "
+                          "{}".format(sites_file))
+            missing.append(sites_index)
+
+    for input_file in input_files:
+        if not exists(input_file):
+            logging.error("Could not find the supplied file "
+                          "{}".format(input_file))
+            missing.append(input_file)
+
+    if not exists(ref):
         logging.error("Reference file not found")
-        sys.exit(-1)
-    if not cloud_storage_exists(client, ref + ".fai"):
+        missing.append(ref)
+    if not exists(ref + ".fai"):
         logging.error("Reference fai index not found")
-        sys.exit(-1)
-    if (not cloud_storage_exists(client, ref + ".dict") and
-            not cloud_storage_exists(client, ref_base + ".dict")):
+        missing.append(ref + ".fai")
+    if not exists(ref + ".dict") and not exists(ref_base + ".dict"):
         logging.error("Reference dict index not found")
-        sys.exit(-1)
+        missing.append(ref_base + ".dict")
     # FQ specific
     if job_vars["FQ1"] or job_vars["TUMOR_FQ1"]:
-        for suffix in [".amb", ".ann", ".bwt", ".pac", ".sa"]:
-            if (not cloud_storage_exists(client, ref + suffix) and
-                    not cloud_storage_exists(client, ref + ".64" + suffix)):
+        for suffix in bwa_suffixes:
+            if (not exists(ref + suffix) and
+                    not exists(ref + ".64" + suffix)):
                 logging.error("Reference BWA index {} not "
                               "found".format(suffix))
-                sys.exit(-1)
+                missing.append(ref + suffix)
     # BAM specific
-    bam_vars = ("BAM", "TUMOR_BAM")
     for bam_type in bam_vars:
         if job_vars[bam_type]:
             for bam in job_vars[bam_type].split(','):
-                if (not cloud_storage_exists(client, bam + ".bai") and
-                        not cloud_storage_exists(client, bam + "bai")):
+                if not exists(bam + ".bai") and not exists(bam + "bai"):
                     logging.error("BAM supplied but BAI not found")
-                    sys.exit(-1)
+                    missing.append(bam + ".bai")
+
+    if missing:
+        logging.error("Missing input files: " + ", ".join(missing))
+        sys.exit(-1)
+
+
+def polling_sleep(interval, max_interval, factor=1.5):
+    '''
+    Sleep for `interval` seconds plus up to 10% jitter, never exceeding
+    `max_interval`
+
+    Returns the next polling interval, grown by `factor` and capped at
+    `max_interval`.
+    '''
+    time.sleep(min(interval + random.uniform(0, interval * 0.1),
+                   max_interval))
+    return min(interval * factor, max_interval)
+
+
+def operation_events(operation):
+    return operation.get("metadata", {}).get("events", [])
+
+
+def wait_for_operation(operations, operation, polling_interval):
+    '''
+    Poll a running operation until it is done and return the final state
+    '''
+    interval = min(initial_polling_interval, polling_interval)
+    while not operation.get("done", False):
+        new_op, tries = None, 0
+        while tries <= 5:
+            interval = polling_sleep(interval, polling_interval)
+            try:
+                new_op = operations.get(name=operation["name"]).execute()
+                break
+            except googleapiclient.errors.HttpError as e:
+                logging.warning(str(e))
+                tries += 1
+            except ssl.SSLError as e:
+                logging.warning(str(e))
+                tries += 1
+        if not new_op:
+            logging.error("Network error while polling running operation.")
+            sys.exit(1)
+        # Poll quickly again after the operation changes state
+        if (len(operation_events(new_op)) !=
+                len(operation_events(operation))):
+            interval = min(initial_polling_interval, polling_interval)
+        operation = new_op
+    logging.debug(JsonDump(operation))
+    return operation
+
+
+def assigned_worker(operation):
+    '''
+    Return the worker assigned to a failed operation, or None if the
+    operation failed before a worker was assigned
+    '''
+    startup_event = next(
+            (x for x in reversed(operation["metadata"]["events"])
+             if worker_assigned_key in x), None)
+    if startup_event is None:
+        return None
+    return startup_event[worker_assigned_key]
+
+
+def exit_if_not_started(operation):
+    '''
+    Exit if a failed operation never had a worker assigned, otherwise
+    return the assigned worker
+    '''
+    worker = assigned_worker(operation)
+    if worker is None:
+        logging.error("Genomics operation failed before running:")
+        logging.error(JsonDump(operation["error"]))
+        sys.exit(2)
+    return worker
+
+
+def was_preempted(operation, project, credentials):
+    '''
+    Check whether a failed operation's worker instance was preempted
+    '''
+    worker = exit_if_not_started(operation)
+    zone = worker["zone"]
+    url = target_url_base.format(
+            project=project, zone=zone, instance=worker["instance"])
+    time.sleep(300)  # It may take some time to set the operation
+    compute_ops = get_compute_service(credentials).zoneOperations().list(
+            project=project, zone=zone,
+            filter=preempted_filter.format(url=url)).execute()
+    return ("items" in compute_ops and
+            any(x["operationType"] == "compute.instances.preempted"
+                for x in compute_ops["items"]))
 
 
 def main(vargs=None):
@@ -148,7 +475,7 @@ def main(vargs=None):
             "--polling_interval",
             type=float,
             default=30,
-            help="Seconds between polling the running operation")
+            help="Maximum seconds between polling the running operation")
     args = parser.parse_args()
     polling_interval = args.polling_interval
 
@@ -166,8 +493,8 @@ def main(vargs=None):
     logging.basicConfig(level=log_level, format=log_format)
 
     # Grab input arguments from the json file
-    job_vars = json.load(open(default_json))
-    job_vars.update(json.load(open(args.pipeline_config)))
+    job_vars = load_config(default_json)
+    job_vars.update(load_config(args.pipeline_config))
     preemptible_tries = int(job_vars["PREEMPTIBLE_TRIES"])
     if job_vars["NONPREEMPTIBLE_TRY"]:
         non_preemptible_tries = 1
@@ -186,25 +513,20 @@ def main(vargs=None):
 
     # Grab the yaml for the workflow
     pipeline = job_vars["PIPELINE"]
-    if pipeline == "GERMLINE":
-        pipeline_yaml = germline_yaml
-    elif pipeline == "SOMATIC":
-        pipeline_yaml = somatic_yaml
-    elif pipeline == "CCDG":
-        pipeline_yaml = ccdg_yaml
-    else:
-        logging.error("Pipeline '" + pipeline + "'. Valid "
-                      "values are 'GERMLINE' and 'SOMATIC'")
+    try:
+        pipeline_yaml, _cmd = pipelines[pipeline]
+    except KeyError:
+        logging.error("Pipeline '" + pipeline + "'. Valid values are " +
+                      str(tuple(sorted(pipelines))))
         sys.exit(-1)
     try:
-        pipeline_dict = yaml.safe_load(open(pipeline_yaml))
-    except IOError:
+        pipeline_dict = load_config(pipeline_yaml, load_yaml)
+    except (IOError, OSError):
         logging.error("No yaml \"{}\" found.".format(pipeline_yaml))
         sys.exit(-1)
 
     # Try not to create nearly empty directories
-    while job_vars["OUTPUT_BUCKET"].endswith('/'):
-        job_vars["OUTPUT_BUCKET"] = job_vars["OUTPUT_BUCKET"][:-1]
+    job_vars["OUTPUT_BUCKET"] = job_vars["OUTPUT_BUCKET"].rstrip('/')
 
     # Some basic error checking to fail early
     if not job_vars["PROJECT_ID"]:
@@ -226,7 +548,7 @@ def main(vargs=None):
         sys.exit(-1)
 
     # Pipeline specific errors
-    if pipeline == "GERMLINE" or pipeline == "CCDG":
+    if pipeline in germline_pipelines:
         if not job_vars["FQ1"] and not job_vars["BAM"]:
             logging.error("Please supply either 'FQ1' or 'BAM'")
             sys.exit(-1)
@@ -251,7 +573,7 @@ def main(vargs=None):
                 logging.error("The CCDG pipeline requires known sites for "
                               "BQSR. Please supply 'BQSR_SITES'")
                 sys.exit(-1)
-    elif pipeline == "SOMATIC":
+    elif pipeline in somatic_pipelines:
         if job_vars["TUMOR_FQ1"] and job_vars["TUMOR_BAM"]:
             logging.error("Please supply either 'TUMOR_FQ1' or 'TUMOR_BAM' "
                           "(not both)")
@@ -310,21 +632,10 @@ def main(vargs=None):
     # Environment
     env_dict = {}
     for input_var in pipeline_dict["inputParameters"]:
-        env_dict[input_var["name"]] = job_vars[input_var["name"]]
-        if env_dict[input_var["name"]] is None:
-            env_dict[input_var["name"]] = "None"
+        value = job_vars[input_var["name"]]
+        env_dict[input_var["name"]] = "None" if value is None else value
 
     # Action
-    if pipeline == "GERMLINE":
-        _cmd = "/opt/sentieon/gc_germline.sh"
-    elif pipeline == "SOMATIC":
-        _cmd = "/opt/sentieon/gc_somatic.sh"
-    elif pipeline == "CCDG":
-        _cmd = "/opt/sentieon/gc_ccdg_germline.sh"
-    else:
-        logging.error("Error: Unknown pipeline " + pipeline)
-        sys.exit(-1)
-
     run_action = {
         "containerName": "run-pipeline",
         "imageUri": job_vars["DOCKER_IMAGE"],
@@ -343,10 +654,10 @@ def main(vargs=None):
             "/bin/bash",
             "-c",
             ("gsutil cp /google/logs/action/1/stderr "
-             "\"{}/worker_logs/stderr.txt\" && "
+             "\"{out}/worker_logs/stderr.txt\" && "
              "gsutil cp /google/logs/action/1/stdout "
-             "\"{}/worker_logs/stdout.txt\"").format(
-                 job_vars["OUTPUT_BUCKET"], job_vars["OUTPUT_BUCKET"])],
+             "\"{out}/worker_logs/stdout.txt\"").format(
+                 out=job_vars["OUTPUT_BUCKET"])],
         "alwaysRun": True
     }
 
@@ -354,56 +665,16 @@ def main(vargs=None):
     project = job_vars["PROJECT_ID"]
     service_parent = "projects/" + project + "/locations/" + region
     service = build('lifesciences', 'v2beta', credentials=credentials)
-    compute_service = build("compute", "v1", credentials=credentials)
+    operations = service.projects().locations().operations()
     operation = None
     counter = 0
 
     while non_preemptible_tries > 0 or preemptible_tries > 0:
         if operation:
-            while not operation.get("done", False):
-                new_op, tries = None, 0
-                while tries <= 5:
-                    time.sleep(polling_interval)
-                    try:
-                        ops = service.projects().locations().operations()
-                        new_op = ops.get(name=operation['name']).execute()
-                        break
-                    except googleapiclient.errors.HttpError as e:
-                        logging.warning(str(e))
-                        tries += 1
-                    except ssl.SSLError as e:
-                        logging.warning(str(e))
-                        tries += 1
-                if not new_op:
-                    logging.error("Network error while polling running "
-                                  "operation.")
-                    sys.exit(1)
-                operation = new_op
-            logging.debug(pformat(operation, indent=2))
+            operation = wait_for_operation(
+                    operations, operation, polling_interval)
             if "error" in operation:
-                assigned_events = list(filter(
-                        lambda x: "workerAssigned" in x.keys(),
-                        operation["metadata"]["events"]))
-                if not assigned_events:
-                    logging.error("Genomics operation failed before running:")
-                    logging.error(pformat(operation["error"], indent=2))
-                    sys.exit(2)
-
-                startup_event = assigned_events[-1]
-                instance = startup_event["workerAssigned"]["instance"]
-                zone = startup_event["workerAssigned"]["zone"]
-                url = target_url_base.format(**locals())
-                time.sleep(300)  # It may take some time to set the operation
-                compute_ops = (
-                        compute_service.zoneOperations().list(
-                            project=project, zone=zone, filter=(
-                                "(targetLink eq {url}) (operationType eq "
-                                "compute.instances.preempted)"
-                            ).format(**locals())).execute())
-                if ("items" in compute_ops and
-                        any([(x["operationType"] ==
-                              "compute.instances.preempted")
-                            for x in compute_ops["items"]])):
+                if was_preempted(operation, project, credentials):
                     logging.warning("Run {} failed. "
                                     "Retrying...".format(counter))
                 else:
@@ -430,7 +701,7 @@ def main(vargs=None):
             }
         }
 
-        logging.debug(pformat(body, indent=2))
+        logging.debug(JsonDump(body))
         sys.stderr.flush()
         backoff, backoff_interval = 0, 1
         while backoff < 6:
@@ -451,48 +722,12 @@ def main(vargs=None):
         else:
             logging.warning("Launched job: " + operation["name"])
         counter += 1
-        logging.debug(pformat(operation, indent=2))
+        logging.debug(JsonDump(operation))
 
     if operation:
-        while not operation.get("done", False):
-            new_op, tries = None, 0
-            while tries <= 5:
-                time.sleep(polling_interval)
-                try:
-                    new_op = service.projects().locations().operations().get(
-                        name=operation["name"]).execute()
-                    break
-                except googleapiclient.errors.HttpError as e:
-                    logging.warning(str(e))
-                    tries += 1
-                except ssl.SSLError:
-                    logging.warning(str(e))
-                    tries += 1
-            if not new_op:
-                logging.error("Network error while waiting for the final "
-                              "operation to finish")
-                sys.exit(1)
-            operation = new_op
-        logging.debug(pformat(operation, indent=2))
+        operation = wait_for_operation(operations, operation, polling_interval)
         if "error" in operation:
-            assigned_events = list(filter(
-                    lambda x: "workerAssigned" in x.keys(),
-                    operation["metadata"]["events"]))
-            if not assigned_events:
-                logging.error("Genomics operation failed before running:")
-                logging.error(pformat(operation["error"], indent=2))
-                sys.exit(2)
-
-            startup_event = assigned_events[-1]
-            instance = startup_event["workerAssigned"]["instance"]
-            zone = startup_event["workerAssigned"]["zone"]
-            url = target_url_base.format(**locals())
-            compute_ops = compute_service.zoneOperations().list(
-                    project=project,
-                    zone=zone,
-                    filter=("(targetLink eq {url}) (operationType eq "
-                            "compute.instances.preempted)").format(
-                        **locals())).execute()
+            exit_if_not_started(operation)
             logging.error("Final run failed.")
         else:
             logging.warning("Operation succeeded")